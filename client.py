@@ -1,71 +1,202 @@
 # client.py
+import asyncio
+import ctypes
+import os
 import socket
-import threading
+import struct
 import time
-import json
 import sys
 
+# Fastest available JSON codec: orjson > ujson > stdlib json.
+# _dumps always returns bytes and _loads accepts bytes, so the hot path
+# never does a separate .encode()/.decode() pass over each message.
+try:
+    import orjson as _json
+    _dumps = _json.dumps
+    _loads = _json.loads
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+    def _dumps(obj):
+        return _json.dumps(obj).encode()
+    _loads = _json.loads
+
+# Chat frames go out as a 1-byte type tag + msgpack tuple when msgpack is
+# installed: smaller on the wire than JSON (no repeated key strings) and
+# cheaper to decode. JSON remains the fallback and stays understood on
+# receive for peers without msgpack. Tags cannot collide with JSON,
+# which always starts with '{'.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+TAG_CHAT = b"\x01"
+TAG_HELLO = 0x02
+
+# Hole-punch hellos carry only (username, seq), so they use a fixed
+# binary header instead of JSON: tag, username length, sequence number,
+# followed by the UTF-8 username. ~5x smaller than the JSON equivalent
+# and packed/unpacked entirely at C level.
+_HELLO = struct.Struct("!BBH")
+
 SIGNALING_SERVER_IP = "198.211.117.27"
 SIGNALING_SERVER_PORT = 5555
 
 PUNCH_COUNT = 12
 PUNCH_INTERVAL = 0.1
+# First packets of a punch go out as one vectored burst (opens the NAT
+# mapping as fast as possible); the rest are spaced keepalives.
+PUNCH_BURST = 4
+
+# sendmmsg(2) lets us hand the kernel several datagrams in one syscall.
+# Linux-only; everything below degrades to a plain sendto loop.
+try:
+    _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    _libc.sendmmsg
+except (OSError, AttributeError):
+    _libc = None
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_uint16),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_char * 8)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+def _sendmmsg(sock, payloads, addr):
+    """Send all payloads to addr in one syscall. True on success."""
+    if _libc is None:
+        return False
+    ip, port = addr
+    try:
+        sa = _sockaddr_in()
+        sa.sin_family = socket.AF_INET
+        sa.sin_port = socket.htons(port)
+        sa.sin_addr = (ctypes.c_ubyte * 4)(*socket.inet_aton(ip))
+        n = len(payloads)
+        bufs = [ctypes.create_string_buffer(p, len(p)) for p in payloads]
+        iovs = (_iovec * n)()
+        msgs = (_mmsghdr * n)()
+        for k in range(n):
+            iovs[k].iov_base = ctypes.cast(bufs[k], ctypes.c_void_p)
+            iovs[k].iov_len = len(payloads[k])
+            msgs[k].msg_hdr.msg_name = ctypes.cast(ctypes.pointer(sa), ctypes.c_void_p)
+            msgs[k].msg_hdr.msg_namelen = ctypes.sizeof(sa)
+            msgs[k].msg_hdr.msg_iov = ctypes.pointer(iovs[k])
+            msgs[k].msg_hdr.msg_iovlen = 1
+        return _libc.sendmmsg(sock.fileno(), msgs, n, 0) == n
+    except Exception:
+        return False
+
+class UDPProto(asyncio.DatagramProtocol):
+    """UDP endpoint for chat/hello datagrams, dispatched by the event loop."""
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.client.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        print("[UDP] error:", exc)
 
 class PeerClient:
     def __init__(self, username, signaling_ip, signaling_port):
         self.username = username
-        # UDP socket bound to random local port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(("", 0))
-        self.sock.settimeout(0.5)
-        self.local_udp_port = self.sock.getsockname()[1]
-
-        # TCP signaling (kept open so server can push)
-        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_lock = threading.Lock()
-
         self.signaling_ip = signaling_ip
         self.signaling_port = signaling_port
 
+        # Set by start(): UDP transport + TCP signaling streams.
+        self.transport = None
+        self.local_udp_port = None
+        self.reader = None
+        self.writer = None
+
         self.peer_ip = None
         self.peer_port = None
         self.peer_username = None
 
-        self.stop_evt = threading.Event()
+        # Invariant message parts, encoded once: hello packets only vary
+        # in seq and the punch count is fixed, so all of them can be
+        # packed up front. The chat prefix additionally depends on the
+        # peer and is (re)built when a peer is assigned. A reused msgpack
+        # Packer keeps its internal buffer across chat sends.
+        uname = username.encode()
+        # The hello header stores the username length in one byte.
+        if len(uname) > 255:
+            raise ValueError("username must be at most 255 UTF-8 bytes")
+        self._hello_payloads = [
+            _HELLO.pack(TAG_HELLO, len(uname), i) + uname
+            for i in range(PUNCH_COUNT)
+        ]
+        self._chat_prefix = None
+        self._packer = msgpack.Packer() if msgpack is not None else None
+
+    async def start(self):
+        """Open the UDP endpoint and the TCP signaling stream, register."""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: UDPProto(self), local_addr=("0.0.0.0", 0))
+        self.local_udp_port = self.transport.get_extra_info("sockname")[1]
+
+        self.reader, self.writer = await asyncio.open_connection(
+            self.signaling_ip, self.signaling_port)
+        sock = self.writer.get_extra_info("socket")
+        # Tiny latency-sensitive control messages: send immediately instead
+        # of letting Nagle hold them for the previous segment's ACK.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # Register username + UDP port
+        self.tcp_send_json({
+            "action": "register",
+            "username": self.username,
+            "udp_port": self.local_udp_port
+        })
 
     # ---------- TCP signaling helpers ----------
     def tcp_send_json(self, obj):
-        data = (json.dumps(obj) + "\n").encode()
-        with self.tcp_lock:
-            self.tcp.sendall(data)
-
-    def signaling_reader(self):
-        buf = b""
-        self.tcp.settimeout(1.0)
-        while not self.stop_evt.is_set():
+        self.writer.write(_dumps(obj) + b"\n")
+
+    async def signaling_reader(self):
+        while True:
             try:
-                chunk = self.tcp.recv(4096)
-                if not chunk:
-                    print("[SIGNAL] disconnected from server")
-                    self.stop_evt.set()
-                    break
-                buf += chunk
-            except socket.timeout:
-                continue
+                line = await self.reader.readline()
             except Exception as e:
                 print("[SIGNAL] error:", e)
-                self.stop_evt.set()
                 break
-
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                if not line.strip():
-                    continue
-                try:
-                    msg = json.loads(line.decode())
-                except json.JSONDecodeError:
-                    continue
-                self.handle_signal(msg)
+            if not line:
+                print("[SIGNAL] disconnected from server")
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                msg = _loads(line)
+            except ValueError:
+                continue
+            self.handle_signal(msg)
 
     def handle_signal(self, msg):
         act = msg.get("action")
@@ -78,21 +209,13 @@ class PeerClient:
             self.peer_username = msg.get("peer_username")
             self.peer_ip = msg.get("peer_ip")
             self.peer_port = int(msg.get("peer_port"))
+            self._chat_prefix = (b'{"type":"chat","from":' + _dumps(self.username)
+                                 + b',"to":' + _dumps(self.peer_username) + b',"ts":')
             print(f"[SIGNAL] peer: {self.peer_username} @ {self.peer_ip}:{self.peer_port}")
             self.start_hole_punch()
         else:
             print("[SIGNAL] unknown msg:", msg)
 
-    def connect_signaling(self):
-        self.tcp.connect((self.signaling_ip, self.signaling_port))
-        # Register username + UDP port
-        self.tcp_send_json({
-            "action": "register",
-            "username": self.username,
-            "udp_port": self.local_udp_port
-        })
-        threading.Thread(target=self.signaling_reader, daemon=True).start()
-
     def request_connect(self, target_username):
         self.tcp_send_json({"action": "connect", "target": target_username})
 
@@ -100,98 +223,131 @@ class PeerClient:
     def start_hole_punch(self):
         if not (self.peer_ip and self.peer_port):
             return
-        def punch():
-            # Send a few empty/hello packets so NATs open mappings both sides
-            for i in range(PUNCH_COUNT):
-                payload = json.dumps({
-                    "type": "hello",
-                    "from": self.username,
-                    "seq": i
-                }).encode()
-                try:
-                    self.sock.sendto(payload, (self.peer_ip, self.peer_port))
-                except Exception as e:
-                    print("[UDP] punch error:", e)
-                time.sleep(PUNCH_INTERVAL)
-            print("[UDP] hole punch packets sent.")
-        threading.Thread(target=punch, daemon=True).start()
+        asyncio.get_running_loop().create_task(self._punch())
+
+    async def _punch(self):
+        # Send a few hello packets so NATs open mappings both sides. The
+        # payloads were packed once at __init__ time.
+        addr = (self.peer_ip, self.peer_port)
+        payloads = self._hello_payloads
+        # Opening burst in one sendmmsg syscall where the platform
+        # supports it, then spaced keepalives for the remainder.
+        start = 0
+        sock = self.transport.get_extra_info("socket")
+        if sock is not None and _sendmmsg(sock, payloads[:PUNCH_BURST], addr):
+            start = PUNCH_BURST
+        for payload in payloads[start:]:
+            try:
+                self.transport.sendto(payload, addr)
+            except Exception as e:
+                print("[UDP] punch error:", e)
+            await asyncio.sleep(PUNCH_INTERVAL)
+        print("[UDP] hole punch packets sent.")
 
     def send_chat(self, text):
         if not (self.peer_ip and self.peer_port):
             print("[UDP] No peer yet. Use /connect <username> first.")
             return
-        packet = {
-            "type": "chat",
-            "from": self.username,
-            "to": self.peer_username,
-            "ts": time.time(),
-            "msg": text
-        }
+        if self._packer is not None:
+            packet = TAG_CHAT + self._packer.pack(
+                (self.username, self.peer_username, time.time(), text))
+        else:
+            packet = (self._chat_prefix + _dumps(time.time())
+                      + b',"msg":' + _dumps(text) + b'}')
         try:
-            self.sock.sendto(json.dumps(packet).encode(), (self.peer_ip, self.peer_port))
+            self.transport.sendto(packet, (self.peer_ip, self.peer_port))
         except Exception as e:
             print("[UDP] send error:", e)
 
-    def udp_receiver(self):
-        while not self.stop_evt.is_set():
-            try:
-                data, addr = self.sock.recvfrom(65535)
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print("[UDP] recv error:", e)
-                break
+    def handle_datagram(self, data, addr):
+        # Tagged binary frames first, JSON for everything else.
+        if data and data[0] == TAG_HELLO and len(data) >= _HELLO.size:
+            # Hole-punch keepalive from the peer; both mappings are open.
+            # Nothing to do beyond having received it.
+            return
 
+        if data[:1] == TAG_CHAT and msgpack is not None:
             try:
-                msg = json.loads(data.decode(errors="ignore"))
-            except json.JSONDecodeError:
-                print(f"[UDP] non-JSON from {addr}: {data[:60]!r}")
-                continue
-
-            mtype = msg.get("type")
-            if mtype == "chat":
-                f = msg.get("from")
-                t = msg.get("to")
-                text = msg.get("msg")
-                print(f"\n[{f} -> {t}] {text}")
-            elif mtype == "hello":
-                # Optional: reply to ensure both mappings are alive
-                pass
-            else:
-                print(f"[UDP] {addr} {msg}")
+                f, t, ts, text = msgpack.unpackb(data[1:], raw=False)
+            except Exception:
+                print(f"[UDP] bad chat frame from {addr}")
+                return
+            print(f"\n[{f} -> {t}] {text}")
+            return
 
-    def close(self):
-        self.stop_evt.set()
-        try:
-            self.tcp.close()
-        except Exception:
-            pass
         try:
-            self.sock.close()
-        except Exception:
+            msg = _loads(data)
+        except ValueError:
+            print(f"[UDP] non-JSON from {addr}: {data[:60]!r}")
+            return
+
+        mtype = msg.get("type")
+        if mtype == "chat":
+            f = msg.get("from")
+            t = msg.get("to")
+            text = msg.get("msg")
+            print(f"\n[{f} -> {t}] {text}")
+        elif mtype == "hello":
+            # Optional: reply to ensure both mappings are alive
             pass
+        else:
+            print(f"[UDP] {addr} {msg}")
 
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        if self.transport is not None:
+            try:
+                self.transport.close()
+            except Exception:
+                pass
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python client.py <your_username>")
-        sys.exit(1)
 
-    me = sys.argv[1]
+async def run(me):
     cli = PeerClient(me, SIGNALING_SERVER_IP, SIGNALING_SERVER_PORT)
-    cli.connect_signaling()
-
-    # Start UDP receive loop
-    threading.Thread(target=cli.udp_receiver, daemon=True).start()
+    await cli.start()
+    reader_task = asyncio.create_task(cli.signaling_reader())
 
     print("Commands:\n"
           "  /connect <username>  - request peer by username\n"
           "  /quit                - exit\n"
           "  (anything else sends a chat message)\n")
 
+    # stdin is just another readable fd on the event loop: add_reader
+    # fires the callback when a line can be read, so there is no blocking
+    # read anywhere and Ctrl-C tears the client down immediately instead
+    # of waiting on a stuck input() thread. None on the queue means EOF.
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    stdin_fd = sys.stdin.fileno()
+    stdin_buf = bytearray()
+
+    def on_stdin():
+        data = os.read(stdin_fd, 4096)
+        if not data:
+            loop.remove_reader(stdin_fd)
+            lines.put_nowait(None)
+            return
+        stdin_buf.extend(data)
+        while True:
+            nl = stdin_buf.find(b"\n")
+            if nl < 0:
+                break
+            lines.put_nowait(stdin_buf[:nl].decode(errors="replace"))
+            del stdin_buf[:nl + 1]
+
+    loop.add_reader(stdin_fd, on_stdin)
+
     try:
         while True:
-            line = input("> ").strip()
+            print("> ", end="", flush=True)
+            line = await lines.get()
+            if line is None:
+                break
+            line = line.strip()
             if not line:
                 continue
             if line.startswith("/connect "):
@@ -201,10 +357,23 @@ def main():
                 break
             else:
                 cli.send_chat(line)
-    except (KeyboardInterrupt, EOFError):
-        pass
     finally:
+        loop.remove_reader(stdin_fd)
+        reader_task.cancel()
         cli.close()
 
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python client.py <your_username>")
+        sys.exit(1)
+    if len(sys.argv[1].encode()) > 255:
+        print("Username too long: at most 255 UTF-8 bytes.")
+        sys.exit(1)
+
+    try:
+        asyncio.run(run(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
     main()
@@ -1,30 +1,322 @@
 # signaling_server.py
+import gc
+import multiprocessing
+import os
+import re
+import select
 import socket
 import threading
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, is_dataclass
 
-# username -> {"conn": socket, "ip": str, "udp_port": int}
+# Fastest available JSON codec: orjson > ujson > stdlib json.
+# _dumps always returns bytes and _loads accepts bytes, so the hot path
+# never does a separate .encode()/.decode() pass over each message.
+# Reply messages are dataclasses; orjson serializes those natively with
+# precomputed field order (no per-message dict build or key hashing),
+# while the fallbacks go through asdict first.
+try:
+    import orjson as _json
+    _OPT = _json.OPT_SERIALIZE_DATACLASS
+    def _dumps(obj):
+        return _json.dumps(obj, option=_OPT)
+    _loads = _json.loads
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+    def _dumps(obj):
+        if is_dataclass(obj):
+            obj = asdict(obj)
+        return _json.dumps(obj).encode()
+    _loads = _json.loads
+
+@dataclass(slots=True, frozen=True)
+class RegisteredMsg:
+    action: str
+    username: str
+
+@dataclass(slots=True, frozen=True)
+class PeerMsg:
+    action: str
+    peer_username: str
+    peer_ip: str
+    peer_port: int
+
+@dataclass(slots=True, frozen=True)
+class ErrorMsg:
+    action: str
+    error: str
+
+class Peer:
+    """Registry record for one online user. Slots keep it to a fraction
+    of a dict's footprint, and connect reads its fields several times per
+    request."""
+    __slots__ = ("conn", "ip", "udp_port")
+
+    def __init__(self, conn, ip, udp_port):
+        self.conn = conn
+        self.ip = ip
+        self.udp_port = udp_port
+
+# username -> Peer
 REGISTRY = {}
-LOCK = threading.Lock()
 
-def send_json(conn, obj):
+# Registry locking is sharded by username hash so unrelated users never
+# contend on one global mutex once message handling runs on worker
+# threads. The reactor itself is single-threaded today, so these are
+# uncontended (and nearly free) until workers are added.
+SHARDS = [threading.Lock() for _ in range(16)]
+
+def _lk(username):
+    return SHARDS[hash(username) & 15]
+
+# Edge-triggered epoll reactor: one wakeup per burst of traffic, and each
+# readable socket is drained with recv_into until EAGAIN, so steady-state
+# receives do zero allocation. The epoll object itself is per-process
+# (see reactor_main).
+ep = None
+FDS = {}  # fd -> ConnState
+# EOF'd connections waiting for their last replies to flush before close.
+EOF_WAIT = set()
+
+RECV_BUF = 8192
+
+# Normal registration mask, and the same with EPOLLOUT while a
+# connection has queued output its socket would not accept.
+_EV_RD = select.EPOLLIN | select.EPOLLET | select.EPOLLRDHUP
+_EV_RW = _EV_RD | select.EPOLLOUT
+
+class ConnState:
+    """Per-connection state for the reactor: preallocated receive buffer."""
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.fd = conn.fileno()
+        self.addr = addr
+        self.buf = bytearray(RECV_BUF)
+        self.view = memoryview(self.buf)
+        self.wpos = 0
+        # Outbound replies accumulate here and go out as one sendall per
+        # reactor pass, so back-to-back messages cost one syscall (and,
+        # with TCP_NODELAY, one packet).
+        self.out = bytearray()
+        # True while the fd is registered for EPOLLOUT because out could
+        # not be fully written.
+        self.wout = False
+        # True once the client sent FIN; the connection is torn down when
+        # its remaining lines are handled and replies flushed.
+        self.eof = False
+        self.username = None
+        # Framed lines waiting for a worker, in arrival order. lock
+        # guards rx and dispatching; at most one drain task per
+        # connection is ever scheduled, so lines are handled FIFO.
+        self.rx = deque()
+        self.dispatching = False
+        self.lock = threading.Lock()
+
+# Parsing and dispatch run on a worker pool so the reactor thread only
+# does recv_into + framing: a slow or large message never delays socket
+# servicing. Note the parsers hold the GIL, so the pool bounds handling
+# latency off the I/O thread rather than spreading parse work across
+# cores.
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Connections with queued output, flushed by the reactor. Workers queue
+# replies under PENDING_LOCK and poke the self-pipe so a sleeping
+# epoll_wait wakes up to write them.
+PENDING = set()
+PENDING_LOCK = threading.Lock()
+# Created per process in reactor_main: each reactor process needs its own
+# epoll instance and wake pipe, so they cannot be made at import time.
+_wake_r = None
+_wake_w = None
+
+def queue_json(state, obj):
+    data = _dumps(obj) + b"\n"
+    with PENDING_LOCK:
+        state.out.extend(data)
+        PENDING.add(state)
+    try:
+        os.write(_wake_w, b"\x00")
+    except BlockingIOError:
+        pass  # pipe full: a wakeup is already pending
+
+def flush_pending():
+    """Write out every connection with queued replies (reactor thread)."""
+    with PENDING_LOCK:
+        batch = list(PENDING)
+        PENDING.clear()
+    for st in batch:
+        flush(st)
+
+def flush(state):
+    """Write as much of state.out as the socket accepts (reactor thread).
+
+    On a full send buffer the remainder stays queued and the fd is armed
+    for EPOLLOUT, so nothing is dropped and no reply is cut mid-line
+    while the client catches up.
+    """
+    while True:
+        with PENDING_LOCK:
+            if not state.out:
+                break
+            data = bytes(state.out)
+        try:
+            n = state.conn.send(data)
+        except BlockingIOError:
+            # Client's receive window is full: wait for writability.
+            if not state.wout:
+                state.wout = True
+                try:
+                    ep.modify(state.fd, _EV_RW)
+                except Exception:
+                    pass
+            return
+        except Exception as e:
+            print(f"[WARN] {state.addr[0]}:{state.addr[1]} send failed, "
+                  f"dropping {len(data)} queued bytes: {e}")
+            with PENDING_LOCK:
+                state.out.clear()
+            break
+        with PENDING_LOCK:
+            del state.out[:n]
+
+    if state.wout:
+        state.wout = False
+        try:
+            ep.modify(state.fd, _EV_RD)
+        except Exception:
+            pass
+
+def submit_dispatch(state, lines):
+    """Hand framed lines to the worker pool (reactor thread).
+
+    Lines go onto the connection's rx deque, and a drain task is only
+    submitted if one is not already scheduled for this connection, so
+    one connection's lines are always handled in arrival order no matter
+    how many workers are free.
+    """
+    with state.lock:
+        state.rx.extend(lines)
+        if state.dispatching:
+            return
+        state.dispatching = True
+    EXECUTOR.submit(_drain_dispatch, state)
+
+def _drain_dispatch(state):
+    """Worker-side parse + handle until the connection's rx runs dry."""
+    while True:
+        with state.lock:
+            if not state.rx:
+                state.dispatching = False
+                break
+            line = state.rx.popleft()
+        try:
+            handle_line(state.conn, state, line)
+        except Exception as e:
+            print(f"[WARN] {state.addr[0]}:{state.addr[1]} dispatch error: {e}")
+    if state.eof:
+        # Wake the reactor so it re-checks whether this EOF'd connection
+        # can be closed (its last lines may have produced no reply).
+        try:
+            os.write(_wake_w, b"\x00")
+        except BlockingIOError:
+            pass
+
+def handle_disconnect(username):
+    with _lk(username):
+        entry = REGISTRY.pop(username, None)
+    if entry:
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        print(f"[INFO] {username} removed")
+
+def close_conn(state):
+    """Unregister from epoll and drop any registry entry."""
     try:
-        data = (json.dumps(obj) + "\n").encode()
-        conn.sendall(data)
+        ep.unregister(state.fd)
     except Exception:
         pass
+    FDS.pop(state.fd, None)
+    EOF_WAIT.discard(state)
+    if state.username:
+        handle_disconnect(state.username)
+    else:
+        try:
+            state.conn.close()
+        except Exception:
+            pass
+    print(f"[INFO] TCP closed for {state.addr[0]}:{state.addr[1]}")
 
-def handle_disconnect(username):
-    with LOCK:
-        if username in REGISTRY:
-            try:
-                REGISTRY[username]["conn"].close()
-            except Exception:
-                pass
-            del REGISTRY[username]
-            print(f"[INFO] {username} removed")
-
-def handle_client(conn, addr):
+# Fast-path field extraction for the two known message shapes. Register
+# and connect messages are flat dicts with a fixed schema, so a couple of
+# C-level regex searches can pull out the needed fields without building
+# a dict per message. Anything the patterns cannot handle (escapes,
+# unusual field values) falls back to the full JSON parse below.
+_ACTION_RE = re.compile(rb'"action"\s*:\s*"([a-z_]+)"')
+_USERNAME_RE = re.compile(rb'"username"\s*:\s*"([^"\\]+)"')
+_UDP_PORT_RE = re.compile(rb'"udp_port"\s*:\s*(\d+)')
+_TARGET_RE = re.compile(rb'"target"\s*:\s*"([^"\\]+)"')
+
+def do_register(conn, state, username, udp_port):
+    addr = state.addr
+    with _lk(username):
+        # If username already in use, drop previous
+        old = REGISTRY.get(username)
+        # addr[0] is the public IP seen by the server
+        REGISTRY[username] = Peer(conn, addr[0], udp_port)
+    if old:
+        try:
+            old.conn.close()
+        except Exception:
+            pass
+    state.username = username
+    print(f"[INFO] registered {username} @ {addr[0]} udp:{udp_port}")
+    queue_json(state, RegisteredMsg("registered", username))
+
+def do_connect(conn, state, target):
+    username = state.username
+    if not username:
+        queue_json(state, ErrorMsg("error", "not_registered"))
+        return
+
+    # Take both shard locks in index order (deadlock-safe), copy the
+    # endpoint info out, and release before any network I/O so a slow
+    # sendall never blocks the registry.
+    i, j = hash(username) & 15, hash(target) & 15
+    first, second = SHARDS[min(i, j)], SHARDS[max(i, j)]
+    with first:
+        if second is not first:
+            second.acquire()
+        try:
+            me = REGISTRY.get(username)
+            other = REGISTRY.get(target)
+            if other:
+                me_conn, me_ip, me_port = me.conn, me.ip, me.udp_port
+                other_conn, other_ip, other_port = other.conn, other.ip, other.udp_port
+        finally:
+            if second is not first:
+                second.release()
+
+    if not other:
+        queue_json(state, ErrorMsg("error", "target_not_online"))
+        return
+
+    # Push peer info to both sides, through each connection's out buffer
+    # so it rides along with anything else queued for that socket.
+    me_state = state if me_conn is conn else FDS.get(me_conn.fileno())
+    other_state = FDS.get(other_conn.fileno())
+    if me_state is not None:
+        queue_json(me_state, PeerMsg("peer", target, other_ip, other_port))
+    if other_state is not None:
+        queue_json(other_state, PeerMsg("peer", username, me_ip, me_port))
+    print(f"[INFO] paired {username} <-> {target}")
+
+def handle_line(conn, state, line):
     """
     Protocol (newline-delimited JSON):
       1) Client sends:
@@ -34,120 +326,206 @@ def handle_client(conn, addr):
       Server replies to BOTH alice and bob with:
          {"action":"peer","peer_username":"<other>","peer_ip":"A.B.C.D","peer_port":NNNN}
     """
-    peername = f"{addr[0]}:{addr[1]}"
-    print(f"[INFO] TCP connected from {peername}")
-
-    username = None
-    buf = b""
-    conn.settimeout(1.0)
+    # Fast path: well-formed register/connect lines, no dict built.
+    m = _ACTION_RE.search(line)
+    if m:
+        act = m.group(1)
+        if act == b"register":
+            mu = _USERNAME_RE.search(line)
+            mp = _UDP_PORT_RE.search(line)
+            if mu and mp:
+                do_register(conn, state, mu.group(1).decode(), int(mp.group(1)))
+                return
+        elif act == b"connect":
+            mt = _TARGET_RE.search(line)
+            if mt:
+                do_connect(conn, state, mt.group(1).decode())
+                return
 
+    # Slow path: full parse for anything the fast path missed.
     try:
-        while True:
-            try:
-                chunk = conn.recv(4096)
-                if not chunk:
-                    # Client closed
-                    break
-                buf += chunk
-            except socket.timeout:
-                chunk = b""
-
-            # Process full lines (newline-delimited JSON)
-            while b"\n" in buf:
-                line, buf = buf.split(b"\n", 1)
-                if not line.strip():
-                    continue
-                try:
-                    msg = json.loads(line.decode())
-                except json.JSONDecodeError:
-                    send_json(conn, {"action":"error","error":"bad_json"})
-                    continue
-
-                act = msg.get("action")
-
-                if act == "register":
-                    # Required fields
-                    username = msg.get("username")
-                    udp_port = msg.get("udp_port")
-                    if not username or not isinstance(udp_port, int):
-                        send_json(conn, {"action":"error","error":"missing_fields"})
-                        continue
-
-                    with LOCK:
-                        # If username already in use, drop previous
-                        if username in REGISTRY:
-                            try:
-                                REGISTRY[username]["conn"].close()
-                            except Exception:
-                                pass
-                        REGISTRY[username] = {
-                            "conn": conn,
-                            "ip": addr[0],   # public IP seen by server
-                            "udp_port": udp_port
-                        }
-                    print(f"[INFO] registered {username} @ {addr[0]} udp:{udp_port}")
-                    send_json(conn, {"action":"registered","username":username})
-
-                elif act == "connect":
-                    if not username:
-                        send_json(conn, {"action":"error","error":"not_registered"})
-                        continue
-                    target = msg.get("target")
-                    if not target:
-                        send_json(conn, {"action":"error","error":"missing_target"})
-                        continue
-
-                    with LOCK:
-                        me = REGISTRY.get(username)
-                        other = REGISTRY.get(target)
-
-                    if not other:
-                        send_json(conn, {"action":"error","error":"target_not_online"})
-                        continue
-
-                    # Push peer info to both sides
-                    my_info = {"ip": me["ip"], "udp_port": me["udp_port"]}
-                    other_info = {"ip": other["ip"], "udp_port": other["udp_port"]}
-
-                    send_json(me["conn"], {
-                        "action":"peer",
-                        "peer_username": target,
-                        "peer_ip": other_info["ip"],
-                        "peer_port": other_info["udp_port"]
-                    })
-                    send_json(other["conn"], {
-                        "action":"peer",
-                        "peer_username": username,
-                        "peer_ip": my_info["ip"],
-                        "peer_port": my_info["udp_port"]
-                    })
-                    print(f"[INFO] paired {username} <-> {target}")
-
-                else:
-                    send_json(conn, {"action":"error","error":"unknown_action"})
-    except Exception as e:
-        print(f"[WARN] {peername} error: {e}")
-    finally:
-        if username:
-            handle_disconnect(username)
-        else:
-            try:
-                conn.close()
-            except Exception:
-                pass
-        print(f"[INFO] TCP closed for {peername}")
+        msg = _loads(line)
+    except ValueError:
+        queue_json(state, ErrorMsg("error", "bad_json"))
+        return
+
+    act = msg.get("action")
+
+    if act == "register":
+        # Required fields
+        username = msg.get("username")
+        udp_port = msg.get("udp_port")
+        if not username or not isinstance(udp_port, int):
+            queue_json(state, ErrorMsg("error", "missing_fields"))
+            return
+        do_register(conn, state, username, udp_port)
+
+    elif act == "connect":
+        target = msg.get("target")
+        if not target:
+            queue_json(state, ErrorMsg("error", "missing_target"))
+            return
+        do_connect(conn, state, target)
+
+    else:
+        queue_json(state, ErrorMsg("error", "unknown_action"))
+
+def service(state):
+    """Drain a readable socket (edge-triggered) and process full lines."""
+    conn = state.conn
+    while True:
+        if state.wpos == len(state.buf):
+            # Line longer than the buffer: double it. The old view must be
+            # released first or the bytearray refuses to resize.
+            state.view.release()
+            state.buf.extend(bytes(len(state.buf)))
+            state.view = memoryview(state.buf)
+        try:
+            n = conn.recv_into(state.view[state.wpos:])
+        except BlockingIOError:
+            break  # socket drained, back to epoll
+        except Exception as e:
+            print(f"[WARN] {state.addr[0]}:{state.addr[1]} error: {e}")
+            close_conn(state)
+            return
+        if n == 0:
+            # Client sent FIN. Data can arrive in the same wakeup (a
+            # half-closing client that writes, shuts down and waits for
+            # the reply), so fall through to framing and tear down only
+            # after its replies have gone out.
+            state.eof = True
+            break
+        state.wpos += n
+
+    # Frame full lines (newline-delimited JSON). count() and find() are
+    # both memchr under the hood (SIMD-accelerated on glibc); counting
+    # first gives exactly one successful find() per line, with no failing
+    # scan over the partial trailing line. Parsing and handling happen on
+    # the worker pool, not here.
+    start = 0
+    lines = []
+    for _ in range(state.buf.count(b"\n", 0, state.wpos)):
+        nl = state.buf.find(b"\n", start, state.wpos)
+        # One copy per line (the worker outlives this buffer's contents);
+        # slicing the view first avoids an intermediate bytearray copy.
+        line = bytes(state.view[start:nl])
+        start = nl + 1
+        if line.strip():
+            lines.append(line)
+
+    # Move any partial trailing line to the front of the buffer.
+    if start:
+        state.buf[:state.wpos - start] = state.buf[start:state.wpos]
+        state.wpos -= start
+
+    if lines:
+        submit_dispatch(state, lines)
+
+    if state.eof:
+        EOF_WAIT.add(state)
+        maybe_close(state)
+
+def maybe_close(state):
+    """Close an EOF'd connection once nothing is left to do for it
+    (reactor thread): no lines waiting or being dispatched, and no
+    queued or half-written replies."""
+    with state.lock:
+        busy = state.dispatching or bool(state.rx)
+    if not busy:
+        with PENDING_LOCK:
+            busy = bool(state.out) or state in PENDING
+    if not busy:
+        EOF_WAIT.discard(state)
+        close_conn(state)
+
+def accept_all(srv):
+    """Accept every pending connection (edge-triggered listener)."""
+    while True:
+        try:
+            conn, addr = srv.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        # Tiny latency-sensitive control messages: send immediately instead
+        # of letting Nagle hold them for the previous segment's ACK.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Let the kernel notice dead peers so their registry entries get pruned.
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        state = ConnState(conn, addr)
+        FDS[state.fd] = state
+        ep.register(state.fd, _EV_RD)
+        print(f"[INFO] TCP connected from {addr[0]}:{addr[1]}")
+
+def reactor_main():
+    global ep, _wake_r, _wake_w
+    ep = select.epoll()
+    _wake_r, _wake_w = os.pipe()
+    os.set_blocking(_wake_r, False)
+    os.set_blocking(_wake_w, False)
 
-def main():
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # SO_REUSEPORT lets several reactor processes bind the same port and
+    # have the kernel spread incoming connections across them.
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     srv.bind(("0.0.0.0", 5555))
     srv.listen(128)
+    srv.setblocking(False)
+    srv_fd = srv.fileno()
+    ep.register(srv_fd, select.EPOLLIN | select.EPOLLET)
+    ep.register(_wake_r, select.EPOLLIN)
     print("Signaling server listening on :5555")
 
+    # Everything long-lived is allocated by now. Freeze it out of the
+    # collector's working set and turn cyclic GC off: the steady-state
+    # message path creates no reference cycles, so the only thing the
+    # collector could contribute here is pauses.
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+
     while True:
-        conn, addr = srv.accept()
-        threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        # Block until something is actually ready: there is no periodic
+        # work, and workers poke the self-pipe when replies need writing.
+        for fd, events in ep.poll(-1):
+            if fd == srv_fd:
+                accept_all(srv)
+                continue
+            if fd == _wake_r:
+                try:
+                    while os.read(_wake_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            state = FDS.get(fd)
+            if state is None:
+                continue
+            if events & (select.EPOLLHUP | select.EPOLLERR):
+                close_conn(state)
+                continue
+            if events & select.EPOLLOUT:
+                flush(state)
+            if events & (select.EPOLLIN | select.EPOLLRDHUP):
+                service(state)
+
+        # One coalesced write per connection that produced output.
+        flush_pending()
+
+        # Tear down EOF'd connections whose replies have all gone out.
+        for st in list(EOF_WAIT):
+            maybe_close(st)
+
+def main():
+    # SIGNALING_WORKERS=N runs N reactor processes on the same port via
+    # SO_REUSEPORT; the kernel load-balances accepted connections across
+    # them. Each process keeps its own in-memory registry, so two peers
+    # can only be paired if they land on the same worker -- scaling past
+    # one process needs an external registry first. Default stays 1.
+    workers = int(os.environ.get("SIGNALING_WORKERS", "1"))
+    for _ in range(max(0, workers - 1)):
+        multiprocessing.Process(target=reactor_main, daemon=True).start()
+    reactor_main()
 
 if __name__ == "__main__":
     main()
-